@@ -3,6 +3,8 @@
 Configurações centralizadas para o script de edição de EPUB.
 """
 
+import re
+
 # Mapeamento de plataformas e suas marcas identificadoras
 PLATFORM_MARKS = {
     "amazon": "▲",
@@ -25,6 +27,12 @@ EXCLUDED_FILE_PATTERNS = [
     r"secao_\d+\.xhtml$"
 ]
 
+# Padrões compilados uma única vez no import: os módulos testam centenas
+# de nomes de arquivo por execução, então não recompilamos a cada chamada.
+# Os excluídos viram uma única alternação (uma varredura por nome).
+ELIGIBLE_FILE_RE = re.compile(ELIGIBLE_FILE_PATTERN)
+EXCLUDED_FILE_RE = re.compile("|".join(f"(?:{p})" for p in EXCLUDED_FILE_PATTERNS))
+
 # Número de arquivos a marcar por EPUB
 NUM_FILES_TO_MARK = 3
 
@@ -5,30 +5,31 @@ Script principal para edição de metadados EPUB e marcação de plataformas.
 Uso:
     python main.py [<caminho_mhtml> <caminho_epub_zip>]
 
-Se os caminhos não forem fornecidos, o script procurará automaticamente 
+Se os caminhos não forem fornecidos, o script procurará automaticamente
 por arquivos .mhtml e .epub dentro da pasta 'input/'.
 
 Exemplo:
-    python main.py 
+    python main.py
     python main.py "arquivo.mhtml" "9786558823230.epub"
 """
 
-import os
 import sys
 import time
-import shutil
 import zipfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from typing import Dict
 
 # Adiciona o diretório atual ao path para imports
 sys.path.insert(0, str(Path(__file__).parent))
 
-from config import PLATFORMS, PLATFORM_MARKS
+from config import PLATFORMS, PLATFORM_MARKS, EPUB_ENCODING
 from modules.mhtml_parser import extract_metadata_from_mhtml
-from modules.opf_editor import update_opf_metadata
-from modules.watermark_manager import add_platform_watermarks
-from modules.integrity_checker import count_xhtml_characters, verify_all_platforms
+from modules.opf_editor import update_opf_bytes
+from modules.watermark_manager import add_platform_watermarks_to_tree
+from modules.integrity_checker import count_characters, count_tree_characters
 
 
 def print_header(text: str) -> None:
@@ -43,81 +44,213 @@ def print_step(step: int, text: str) -> None:
     print(f"\n[{step}] {text}")
 
 
-def extract_epub(epub_path: str, dest_path: str) -> str:
+# Extensões de mídia já comprimida: DEFLATE ganha <1% de tamanho
+# nesses formatos e só gasta CPU, então são armazenadas sem compressão
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif',
+    '.mp3', '.mp4', '.m4a',
+    '.woff', '.woff2', '.otf', '.ttf'
+}
+
+
+def load_epub(epub_path: str) -> Dict[str, bytes]:
     """
-    Extrai um arquivo EPUB para um diretório.
-    
+    Carrega em memória apenas as entradas editáveis de um EPUB.
+
+    O pipeline só lê/modifica o content.opf e os arquivos .xhtml; as
+    demais entradas (imagens, fontes, css, mídia) permanecem no zip de
+    origem e são copiadas diretamente para os EPUBs de saída, sem nunca
+    serem infladas no processo.
+
     Args:
         epub_path: Caminho para o arquivo EPUB/ZIP.
-        dest_path: Diretório de destino.
-        
+
     Returns:
-        Caminho para a pasta OEBPS.
+        Dicionário {caminho_interno: bytes} das entradas editáveis.
     """
     with zipfile.ZipFile(epub_path, 'r') as zf:
-        zf.extractall(dest_path)
-    
-    # Encontra a pasta OEBPS
-    oebps = Path(dest_path) / "OEBPS"
-    if oebps.exists():
-        return str(oebps)
-    
-    # Procura em subdiretórios
-    for subdir in Path(dest_path).iterdir():
-        if subdir.is_dir():
-            oebps = subdir / "OEBPS"
-            if oebps.exists():
-                return str(oebps)
-    
-    raise FileNotFoundError("Pasta OEBPS não encontrada no EPUB")
-
-
-def create_epub(source_dir: str, epub_path: str) -> None:
+        return {
+            name: zf.read(name)
+            for name in zf.namelist()
+            if name.endswith('.xhtml') or name.endswith('content.opf')
+        }
+
+
+def find_opf_name(files: Dict[str, bytes]) -> str:
+    """
+    Localiza o content.opf dentro da árvore em memória.
+
+    Args:
+        files: Dicionário {caminho_interno: bytes} do EPUB.
+
+    Returns:
+        Caminho interno do content.opf.
     """
-    Cria um arquivo EPUB a partir de um diretório.
-    
+    for name in files:
+        if name.endswith("content.opf"):
+            return name
+
+    raise FileNotFoundError("content.opf não encontrado no EPUB")
+
+
+def create_epub(files: Dict[str, bytes], epub_path: str, source_epub_path: str = None) -> None:
+    """
+    Cria um arquivo EPUB a partir das entradas modificadas em memória.
+
+    Quando source_epub_path é informado, as entradas ausentes de `files`
+    são copiadas diretamente do EPUB de origem, preservando a ordem
+    original.
+
     Args:
-        source_dir: Diretório fonte (raiz do EPUB extraído).
+        files: Dicionário {caminho_interno: bytes} das entradas em memória.
         epub_path: Caminho para o arquivo EPUB de saída.
+        source_epub_path: Caminho para o EPUB de origem (opcional).
     """
-    with zipfile.ZipFile(epub_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-        # O mimetype deve ser o primeiro arquivo e sem compressão
-        mimetype_path = Path(source_dir) / "mimetype"
-        if mimetype_path.exists():
-            zf.write(mimetype_path, "mimetype", compress_type=zipfile.ZIP_STORED)
-        
-        # Adiciona todos os outros arquivos
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                if file == "mimetype":
+    def write_entry(zf, name, data):
+        info = zipfile.ZipInfo(name)
+        info.extra = b''
+
+        if Path(name).suffix.lower() in STORED_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+            zf.writestr(info, data)
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, data, compresslevel=3)
+
+    source = zipfile.ZipFile(source_epub_path, 'r') if source_epub_path else None
+    try:
+        if source is not None:
+            names = [n for n in source.namelist() if not n.endswith('/')]
+        else:
+            names = list(files)
+
+        # Buffer de 1 MiB na saída (uma escrita sequencial grande por
+        # entrada) e sem suporte a ZIP64, desnecessário para EPUBs < 2 GiB
+        with open(epub_path, 'wb', buffering=1 << 20) as out, \
+                zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=False) as zf:
+            # O mimetype deve ser o primeiro arquivo, sem compressão e sem
+            # extra field (exigência do OCF para EPUBs "streamáveis")
+            if "mimetype" in names:
+                mimetype = files.get("mimetype")
+                if mimetype is None:
+                    mimetype = source.read("mimetype")
+
+                info = zipfile.ZipInfo("mimetype")
+                info.compress_type = zipfile.ZIP_STORED
+                info.extra = b''
+                zf.writestr(info, mimetype)
+
+            # Demais entradas: as modificadas saem da memória, o resto é
+            # copiado do zip de origem; mídia já comprimida é apenas
+            # armazenada e texto é comprimido com nível leve
+            for name in names:
+                if name == "mimetype":
                     continue
-                file_path = Path(root) / file
-                arcname = file_path.relative_to(source_dir)
-                zf.write(file_path, arcname)
+
+                data = files.get(name)
+                if data is None:
+                    data = source.read(name)
+
+                write_entry(zf, name, data)
+    finally:
+        if source is not None:
+            source.close()
+
+
+def process_platform(platform: str,
+                     original_files: Dict[str, bytes],
+                     opf_name: str,
+                     metadata: Dict[str, str],
+                     original_count: int,
+                     platform_dir: str,
+                     isbn: str,
+                     epub_path: str,
+                     paranoid: bool = False) -> dict:
+    """
+    Processa uma plataforma completa: metadados, marcas, integridade e EPUB.
+
+    Cada plataforma é independente das demais (sem estado compartilhado),
+    então esta função roda em um worker de ProcessPoolExecutor.
+
+    Args:
+        platform: Nome da plataforma.
+        original_files: Entradas editáveis originais {caminho_interno: bytes}.
+        opf_name: Caminho interno do content.opf.
+        metadata: Metadados extraídos do MHTML.
+        original_count: Contagem de caracteres do EPUB original.
+        platform_dir: Diretório de saída da plataforma.
+        isbn: ISBN usado no nome do EPUB final.
+        epub_path: Caminho do EPUB de origem (entradas não editáveis).
+        paranoid: Se True, reconta a árvore inteira na verificação de
+            integridade em vez de derivar a contagem dos arquivos mudados.
+
+    Returns:
+        Dicionário com resultados da plataforma.
+    """
+    mark = PLATFORM_MARKS[platform]
+    files = dict(original_files)
+
+    # Metadados
+    files[opf_name] = update_opf_bytes(files[opf_name], metadata)
+
+    # Marcas
+    results = add_platform_watermarks_to_tree(files, mark)
+    files_marked = [f for f, success in results if success]
+
+    if paranoid:
+        # Verificação completa: reconta todos os arquivos da árvore
+        modified_count = count_tree_characters(files, exclude_marks=True)
+    else:
+        # Integridade fundida à marcação: em vez de reler a árvore
+        # inteira, reconta (sem marcas) apenas os arquivos que de fato
+        # mudaram e deriva o total a partir da contagem original
+        stripped_delta = sum(
+            count_characters(files[name].decode(EPUB_ENCODING))
+            - count_characters(original_files[name].decode(EPUB_ENCODING))
+            for name in files
+            if name.endswith(".xhtml") and files[name] is not original_files[name]
+        )
+        modified_count = original_count + stripped_delta
+
+    # EPUB final (entradas não editáveis copiadas direto da origem)
+    output_epub = Path(platform_dir) / f"{isbn}.epub"
+    create_epub(files, str(output_epub), source_epub_path=epub_path)
+
+    return {
+        'platform': platform,
+        'mark': mark,
+        'files_marked': files_marked,
+        'count': modified_count,
+        'passed': modified_count == original_count,
+        'difference': modified_count - original_count,
+    }
 
 
 def main():
     """Função principal."""
     # Inicia timer
     start_time = time.time()
-    
+
     print_header("EPUB Metadata Editor & Platform Watermarking")
-    
+
     # Parse argumentos
     parser = argparse.ArgumentParser(description='Edita metadados EPUB e adiciona marcas de plataforma.')
     parser.add_argument('mhtml', nargs='?', help='Caminho para o arquivo MHTML de cadastro')
     parser.add_argument('epub', nargs='?', help='Caminho para o arquivo EPUB (.epub ou .zip)')
+    parser.add_argument('--paranoid', action='store_true',
+                        help='Reconta todos os arquivos na verificação de integridade '
+                             '(por padrão só os arquivos modificados são recontados)')
     args = parser.parse_args()
-    
+
     # Configura diretórios
     base_dir = Path(__file__).parent
     input_dir = base_dir / "input"
     output_base_dir = base_dir / "output"
-    
+
     # Garante que diretórios existam
     input_dir.mkdir(exist_ok=True)
     output_base_dir.mkdir(exist_ok=True)
-    
+
     if args.mhtml:
         mhtml_path = args.mhtml
     else:
@@ -128,7 +261,7 @@ def main():
             sys.exit(1)
         mhtml_path = str(mhtml_files[0])
         print(f"  Usando MHTML: {mhtml_files[0].name}")
-    
+
     if args.epub:
         epub_path = args.epub
     else:
@@ -139,134 +272,92 @@ def main():
             sys.exit(1)
         epub_path = str(epub_files[0])
         print(f"  Usando EPUB: {epub_files[0].name}")
-    
+
     # Passo 1: Extrair metadados do MHTML
     print_step(1, f"Extraindo metadados de: {Path(mhtml_path).name}")
     metadata = extract_metadata_from_mhtml(mhtml_path)
-    
+
     isbn = metadata.get('isbn')
     if not isbn:
         print("ERRO: ISBN não encontrado nos metadados.")
         sys.exit(1)
-        
+
     print(f"  ISBN identificado: {isbn}")
     print("  Metadados extraídos:")
     for key, value in metadata.items():
         print(f"    {key}: {value}")
-    
+
     # Passo 2: Criar diretórios de saída baseados no ISBN
     print_step(2, f"Criando diretórios de saída em output/{isbn}/...")
     isbn_dir = output_base_dir / isbn
     isbn_dir.mkdir(exist_ok=True)
-    
+
     platform_dirs = {}
     for platform in PLATFORMS:
         platform_dir = isbn_dir / platform
         platform_dir.mkdir(exist_ok=True)
         platform_dirs[platform] = str(platform_dir)
         print(f"    ✓ {platform}/")
-    
-    # Passo 3: Copiar e extrair EPUB para cada plataforma
-    print_step(3, "Copiando e extraindo EPUB para cada plataforma...")
-    
-    # Pasta temporária para extração original
-    temp_original = base_dir / "_temp_original"
-    if temp_original.exists():
-        shutil.rmtree(temp_original)
-    temp_original.mkdir()
-    
+
+    # Passo 3: Carregar EPUB em memória (uma única leitura do disco)
+    print_step(3, "Carregando EPUB em memória...")
+
     try:
-        original_oebps = extract_epub(epub_path, str(temp_original))
+        original_files = load_epub(epub_path)
+        opf_name = find_opf_name(original_files)
     except Exception as e:
-        print(f"ERRO ao extrair EPUB: {e}")
-        shutil.rmtree(temp_original)
+        print(f"ERRO ao carregar EPUB: {e}")
         sys.exit(1)
-        
-    original_count = count_xhtml_characters(original_oebps, exclude_marks=True)
+
+    original_count = count_tree_characters(original_files, exclude_marks=True)
+    print(f"    Entradas editáveis carregadas: {len(original_files)}")
     print(f"    Contagem original de caracteres: {original_count:,}")
-    
-    platform_oebps = {}
-    
-    for platform in PLATFORMS:
-        platform_extract = Path(platform_dirs[platform]) / "epub_content"
-        if platform_extract.exists():
-            shutil.rmtree(platform_extract)
-        
-        # Copia o EPUB extraído
-        shutil.copytree(temp_original, platform_extract)
-        
-        oebps_path = str(platform_extract / "OEBPS")
-        if not Path(oebps_path).exists():
-            # Procura em subdiretórios
-            for subdir in platform_extract.iterdir():
-                if subdir.is_dir():
-                    oebps = subdir / "OEBPS"
-                    if oebps.exists():
-                        oebps_path = str(oebps)
-                        break
-        
-        platform_oebps[platform] = oebps_path
-        print(f"    ✓ {platform}: extraído")
-    
-    # Passo 4: Atualizar metadados em cada cópia
-    print_step(4, "Atualizando metadados em cada cópia...")
-    
-    for platform, oebps_path in platform_oebps.items():
-        opf_path = Path(oebps_path) / "content.opf"
-        if opf_path.exists():
-            update_opf_metadata(str(opf_path), metadata)
-            print(f"    ✓ {platform}: content.opf atualizado")
-        else:
-            print(f"    ✗ {platform}: content.opf não encontrado")
-    
-    # Passo 5: Adicionar watermarks
-    print_step(5, "Adicionando marcas de plataforma...")
-    
-    for platform, oebps_path in platform_oebps.items():
-        mark = PLATFORM_MARKS[platform]
-        results = add_platform_watermarks(oebps_path, mark)
-        
-        files_marked = [f for f, success in results if success]
-        print(f"    ✓ {platform} ({mark}): {len(files_marked)} arquivos marcados")
-    
-    # Passo 6: Verificar integridade
-    print_step(6, "Verificando integridade do conteúdo...")
-    
-    integrity_results = verify_all_platforms(original_oebps, platform_oebps)
+
+    # Passo 4: Processar plataformas em paralelo
+    # Cada worker recebe a árvore original e só diverge nos arquivos
+    # modificados (content.opf + xhtml marcados)
+    print_step(4, "Processando plataformas em paralelo (metadados + marcas + EPUB)...")
+
+    with ProcessPoolExecutor(max_workers=len(PLATFORMS)) as executor:
+        platform_results = list(executor.map(
+            process_platform,
+            PLATFORMS,
+            repeat(original_files),
+            repeat(opf_name),
+            repeat(metadata),
+            repeat(original_count),
+            [platform_dirs[platform] for platform in PLATFORMS],
+            repeat(isbn),
+            repeat(epub_path),
+            repeat(args.paranoid)
+        ))
+
+    for result in platform_results:
+        print(f"    ✓ {result['platform']} ({result['mark']}): "
+              f"content.opf atualizado, {len(result['files_marked'])} arquivos marcados, "
+              f"{result['platform']}/{isbn}.epub criado")
+
+    # Passo 5: Verificar integridade
+    print_step(5, "Verificando integridade do conteúdo...")
+
     all_passed = True
-    
-    for platform, result in integrity_results['platforms'].items():
+
+    for result in platform_results:
         if result['passed']:
-            print(f"    ✓ {platform}: OK ({result['count']:,} caracteres)")
+            print(f"    ✓ {result['platform']}: OK ({result['count']:,} caracteres)")
         else:
-            print(f"    ✗ {platform}: FALHOU (diferença: {result['difference']:+,})")
+            print(f"    ✗ {result['platform']}: FALHOU (diferença: {result['difference']:+,})")
             all_passed = False
-    
+
     if all_passed:
         print("\n  ✓ INTEGRIDADE VERIFICADA: Todos os conteúdos permanecem consistentes")
     else:
         print("\n  ✗ ALERTA: Algumas verificações falharam")
-    
-    # Passo 7: Criar EPUBs finais
-    print_step(7, "Criando arquivos EPUB finais...")
-    
-    for platform in PLATFORMS:
-        platform_extract = Path(platform_dirs[platform]) / "epub_content"
-        output_epub = Path(platform_dirs[platform]) / f"{isbn}.epub"
-        
-        create_epub(str(platform_extract), str(output_epub))
-        print(f"    ✓ {platform}/{isbn}.epub")
-        
-        # Remove pasta temporária
-        shutil.rmtree(platform_extract)
-    
-    # Limpa pasta temporária original
-    shutil.rmtree(temp_original)
-    
+
     # Calcula tempo total
     end_time = time.time()
     elapsed = end_time - start_time
-    
+
     print_header("PROCESSO CONCLUÍDO")
     print(f"\n  Tempo total: {elapsed:.2f} segundos")
     print(f"  EPUBs gerados: {len(PLATFORMS)}")
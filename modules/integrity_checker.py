@@ -4,46 +4,79 @@ Módulo para verificação de integridade do conteúdo EPUB.
 """
 
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, List
+from typing import Dict, Tuple
 
 import sys
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from config import PLATFORM_MARKS, MARK_TEMPLATE
+from config import PLATFORM_MARKS, MARK_TEMPLATE, EPUB_ENCODING
 
 
-def get_mark_patterns() -> List[str]:
-    """
-    Retorna padrões regex para todas as marcas de plataforma.
-    
-    Returns:
-        Lista de padrões regex.
-    """
-    patterns = []
-    for mark in PLATFORM_MARKS.values():
-        # Escapa o caractere e cria padrão para a linha completa
-        pattern = rf'<p[^>]*style\s*=\s*["\']text-align:\s*center;?["\'][^>]*>\s*{re.escape(mark)}\s*</p>\s*'
-        patterns.append(pattern)
-    return patterns
+# Padrão combinado (alternação) para as marcas de todas as plataformas,
+# compilado uma única vez no import: uma varredura por conteúdo em vez
+# de uma recompilação + varredura por marca a cada chamada
+_MARK_PATTERN_SRC = '|'.join(
+    rf'<p[^>]*style\s*=\s*["\']text-align:\s*center;?["\'][^>]*>\s*{re.escape(mark)}\s*</p>\s*'
+    for mark in PLATFORM_MARKS.values()
+)
+_MARK_PATTERNS = re.compile(_MARK_PATTERN_SRC, re.IGNORECASE)
+_MARK_PATTERNS_B = re.compile(_MARK_PATTERN_SRC.encode(EPUB_ENCODING), re.IGNORECASE)
+
+# Bytes de continuação UTF-8 (0x80–0xBF): removê-los via translate deixa
+# exatamente um byte por caractere, o que permite contar caracteres sem
+# decodificar o conteúdo para str
+_UTF8_CONTINUATION = bytes(range(0x80, 0xC0))
 
 
 def count_characters(content: str, exclude_marks: bool = True) -> int:
     """
     Conta caracteres em um conteúdo, opcionalmente excluindo marcas.
-    
+
     Args:
         content: Conteúdo a contar.
         exclude_marks: Se True, remove marcas antes de contar.
-        
+
     Returns:
         Número de caracteres.
     """
+    total = len(content)
+
     if exclude_marks:
-        # Remove todas as marcas de plataforma
-        for pattern in get_mark_patterns():
-            content = re.sub(pattern, '', content, flags=re.IGNORECASE)
-    
-    return len(content)
+        # Desconta o tamanho de cada marca encontrada, sem alocar uma
+        # cópia do conteúdo só para medir o comprimento
+        total -= sum(
+            end - start
+            for start, end in (m.span() for m in _MARK_PATTERNS.finditer(content))
+        )
+
+    return total
+
+
+def count_characters_bytes(raw: bytes, exclude_marks: bool = True) -> int:
+    """
+    Conta caracteres de um conteúdo UTF-8 ainda em bytes.
+
+    Equivalente a count_characters(raw.decode('utf-8'), ...) mas sem a
+    alocação do str (2–4x o tamanho dos bytes): a contagem remove os
+    bytes de continuação UTF-8 em uma passada C.
+
+    Args:
+        raw: Conteúdo em bytes (UTF-8).
+        exclude_marks: Se True, exclui marcas da contagem.
+
+    Returns:
+        Número de caracteres.
+    """
+    total = len(raw.translate(None, _UTF8_CONTINUATION))
+
+    if exclude_marks:
+        total -= sum(
+            len(raw[start:end].translate(None, _UTF8_CONTINUATION))
+            for start, end in (m.span() for m in _MARK_PATTERNS_B.finditer(raw))
+        )
+
+    return total
 
 
 def count_xhtml_characters(oebps_path: str, exclude_marks: bool = True) -> int:
@@ -57,14 +90,42 @@ def count_xhtml_characters(oebps_path: str, exclude_marks: bool = True) -> int:
     Returns:
         Número total de caracteres.
     """
-    total = 0
     oebps = Path(oebps_path)
-    
-    for xhtml_file in oebps.glob("*.xhtml"):
-        with open(xhtml_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        total += count_characters(content, exclude_marks)
-    
+    xhtml_files = list(oebps.glob("*.xhtml"))
+
+    if not xhtml_files:
+        return 0
+
+    # Leituras em paralelo: o GIL é liberado durante o read(), então as
+    # esperas de I/O dos arquivos se sobrepõem; a contagem trabalha
+    # direto nos bytes, sem decodificar para str
+    with ThreadPoolExecutor(max_workers=min(8, len(xhtml_files))) as executor:
+        return sum(
+            count_characters_bytes(raw, exclude_marks)
+            for raw in executor.map(Path.read_bytes, xhtml_files)
+        )
+
+
+def count_tree_characters(files: Dict[str, bytes], exclude_marks: bool = True) -> int:
+    """
+    Conta caracteres totais dos arquivos XHTML de um EPUB em memória.
+
+    Variante de count_xhtml_characters para o pipeline em memória: opera
+    sobre o dicionário {caminho_interno: bytes} sem tocar o disco.
+
+    Args:
+        files: Dicionário {caminho_interno: bytes} do EPUB.
+        exclude_marks: Se True, exclui marcas da contagem.
+
+    Returns:
+        Número total de caracteres.
+    """
+    total = 0
+
+    for name, data in files.items():
+        if name.endswith(".xhtml"):
+            total += count_characters_bytes(data, exclude_marks)
+
     return total
 
 
@@ -86,18 +147,23 @@ def verify_integrity(original_path: str, modified_path: str) -> Tuple[bool, int,
     return passed, original_count, modified_count
 
 
-def verify_all_platforms(original_oebps: str, platform_dirs: dict) -> dict:
+def verify_all_platforms(original_oebps, platform_dirs: dict) -> dict:
     """
     Verifica integridade de todas as cópias de plataforma.
-    
+
     Args:
-        original_oebps: Caminho para OEBPS original.
+        original_oebps: Caminho para OEBPS original, ou contagem de
+            caracteres já calculada (evita reler o original quando o
+            chamador já contou).
         platform_dirs: Dicionário {plataforma: caminho_oebps}.
-        
+
     Returns:
         Dicionário com resultados por plataforma.
     """
-    original_count = count_xhtml_characters(original_oebps, exclude_marks=True)
+    if isinstance(original_oebps, int):
+        original_count = original_oebps
+    else:
+        original_count = count_xhtml_characters(original_oebps, exclude_marks=True)
     
     results = {
         'original_count': original_count,
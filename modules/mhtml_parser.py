@@ -4,28 +4,111 @@ Módulo para extração de metadados de arquivos MHTML.
 """
 
 import re
+import mmap
 import quopri
 from pathlib import Path
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 
 
 import email
-from email import policy
+
+
+def _find_html_part(mhtml_path: str) -> str:
+    """
+    Localiza e decodifica a parte text/html por varredura direta dos bytes.
+
+    Evita montar a árvore MIME completa (que decodifica também as imagens
+    em base64 que nunca usamos): o arquivo é mapeado em memória e apenas
+    a fatia da parte HTML é decodificada.
+
+    Args:
+        mhtml_path: Caminho para o arquivo MHTML.
+
+    Returns:
+        Conteúdo HTML decodificado, ou string vazia se a varredura falhar.
+    """
+    with open(mhtml_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Localiza o cabeçalho da parte HTML
+            part_start = mm.find(b'Content-Type: text/html')
+            if part_start == -1:
+                return ""
+
+            # Boundary declarado no Content-Type raiz: delimita as partes
+            # de verdade — procurar um "--" genérico truncaria o corpo em
+            # qualquer linha que comece com "--" (ex: fim de comentário
+            # HTML "-->")
+            boundary_match = re.search(
+                rb'boundary\s*=\s*"?([^";\r\n]+)',
+                mm[:part_start]
+            )
+            if boundary_match is None:
+                # Sem boundary não dá para delimitar com segurança;
+                # deixa o fallback MIME cuidar do arquivo
+                return ""
+            boundary = boundary_match.group(1).strip()
+
+            # Fim dos cabeçalhos da parte (linha em branco)
+            header_end = mm.find(b'\r\n\r\n', part_start)
+            separator_len = 4
+            if header_end == -1:
+                header_end = mm.find(b'\n\n', part_start)
+                separator_len = 2
+            if header_end == -1:
+                return ""
+
+            headers = mm[part_start:header_end].lower()
+            body_start = header_end + separator_len
+
+            # O corpo termina no próximo delimitador de boundary ou no
+            # fim do arquivo
+            body_end = mm.find(b'\r\n--' + boundary, body_start)
+            if body_end == -1:
+                body_end = mm.find(b'\n--' + boundary, body_start)
+            if body_end == -1:
+                body_end = mm.size()
+
+            body = mm[body_start:body_end]
+
+    # Decodifica o Content-Transfer-Encoding da parte
+    if b'quoted-printable' in headers:
+        body = quopri.decodestring(body)
+    elif b'base64' in headers:
+        import base64
+        body = base64.b64decode(body)
+
+    # Charset declarado nos cabeçalhos da parte
+    charset_match = re.search(rb'charset\s*=\s*"?([\w-]+)', headers)
+    charset = charset_match.group(1).decode('ascii') if charset_match else 'windows-1252'
+
+    return body.decode(charset, errors='replace')
+
 
 def decode_mhtml(mhtml_path: str) -> str:
     """
     Decodifica um arquivo MHTML extraindo a parte text/html.
-    
+
     Args:
         mhtml_path: Caminho para o arquivo MHTML.
-        
+
     Returns:
         Conteúdo HTML decodificado.
     """
+    # Caminho rápido: varredura direta sem montar a árvore MIME
+    try:
+        html = _find_html_part(mhtml_path)
+        if html:
+            return html
+    except Exception as e:
+        print(f"Erro na varredura direta do MHTML: {e}")
+
     try:
+        # Fallback MIME sem policy.default: a canonicalização de headers
+        # do EmailMessage é pure-Python e desnecessária aqui — só
+        # precisamos de walk() + get_payload(decode=True)
         with open(mhtml_path, 'rb') as f:
-            msg = email.message_from_binary_file(f, policy=policy.default)
-        
+            msg = email.message_from_binary_file(f)
+
         # Procura pela parte HTML
         for part in msg.walk():
             if part.get_content_type() == 'text/html':
@@ -45,56 +128,39 @@ def decode_mhtml(mhtml_path: str) -> str:
         return decoded.decode('utf-8', errors='replace')
 
 
-def extract_input_value(html: str, field_name: str) -> str:
-    """
-    Extrai o valor de um campo input pelo atributo name.
-    
-    Args:
-        html: Conteúdo HTML.
-        field_name: Nome do campo input.
-        
-    Returns:
-        Valor do campo ou string vazia se não encontrado.
+def collect_input_fields(doc) -> tuple:
     """
-    # Padrão para encontrar input com name específico e extrair value
-    pattern = rf'name\s*=\s*["\']?{re.escape(field_name)}["\']?\s+[^>]*value\s*=\s*["\']([^"\']*)["\']'
-    match = re.search(pattern, html, re.IGNORECASE | re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    
-    # Tentar padrão alternativo (value antes de name)
-    pattern = rf'value\s*=\s*["\']([^"\']*)["\'][^>]*name\s*=\s*["\']?{re.escape(field_name)}["\']?'
-    match = re.search(pattern, html, re.IGNORECASE | re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    
-    return ""
+    Coleta todos os campos <input> do documento em uma única passada.
 
+    Substitui as buscas regex campo a campo (que varriam o HTML inteiro
+    a cada chamada) por uma varredura única do DOM.
 
-def extract_checked_checkbox(html: str, field_name: str) -> str:
-    """
-    Extrai o texto associado a um checkbox marcado.
-    
     Args:
-        html: Conteúdo HTML.
-        field_name: Nome do grupo de checkboxes.
-        
+        doc: Documento lxml retornado por parse_html.
+
     Returns:
-        Nome do selo/editora marcado.
+        Tupla (values, checked):
+        - values: dicionário {name: value} dos inputs.
+        - checked: dicionário {grupo: texto} dos checkboxes marcados
+          (grupos no formato "nome[]", texto é o rótulo após o input).
     """
-    # Procura por checkbox com checked e extrai o texto após
-    pattern = rf'<input[^>]*name\s*=\s*["\']?{re.escape(field_name)}\[\]["\']?[^>]*checked\s*=\s*["\']?checked["\']?[^>]*>\s*([^<]+)'
-    match = re.search(pattern, html, re.IGNORECASE | re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    
-    # Tentar padrão com checked antes dos outros atributos
-    pattern = rf'<input[^>]*checked\s*=\s*["\']?checked["\']?[^>]*name\s*=\s*["\']?{re.escape(field_name)}\[\]["\']?[^>]*>\s*([^<]+)'
-    match = re.search(pattern, html, re.IGNORECASE | re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    
-    return ""
+    values = {}
+    checked = {}
+
+    for inp in doc.xpath('//input[@name]'):
+        name = inp.get('name')
+
+        # Primeira ocorrência vence (mesmo comportamento da busca regex)
+        if name not in values:
+            values[name] = (inp.get('value') or '').strip()
+
+        # Checkbox marcado de grupo "nome[]": o rótulo vem logo após a tag
+        if name.endswith('[]') and inp.get('checked') is not None:
+            group = name[:-2]
+            if group not in checked:
+                checked[group] = (inp.tail or '').strip()
+
+    return values, checked
 
 
 def parse_subject_from_classification(classification: str) -> str:
@@ -123,60 +189,63 @@ def parse_subject_from_classification(classification: str) -> str:
     return classification
 
 
-def extract_sinopse_from_html(html: str) -> str:
+def parse_html(html: str):
     """
-    Extrai o texto da Sinopse do HTML decodificado.
-    
+    Parseia o HTML decodificado uma única vez com lxml.
+
     Args:
         html: Conteúdo HTML decodificado.
-        
+
+    Returns:
+        Elemento raiz do documento (lxml).
+    """
+    return lxml_html.fromstring(html)
+
+
+def extract_sinopse_from_doc(doc) -> str:
+    """
+    Extrai o texto da Sinopse de um documento já parseado.
+
+    Args:
+        doc: Documento lxml retornado por parse_html.
+
     Returns:
         Texto da sinopse limpo.
     """
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # Procura pelo <td> que contém "Sinopse"
-    sinopse_label = soup.find('td', string=re.compile(r'Sinopse', re.IGNORECASE))
-    if sinopse_label:
-        # Pega o próximo <td> que deve conter o texto
-        sinopse_content = sinopse_label.find_next_sibling('td')
-        if sinopse_content:
-            # Pega o texto, preservando parágrafos com quebras de linha se necessário
-            # ou apenas o texto limpo como solicitado
-            text = sinopse_content.get_text(separator=' ', strip=True)
-            # Remove múltiplos espaços e quebras de linha estranhas
-            text = re.sub(r'\s+', ' ', text).strip()
-            return text
-            
+    # Procura pelo <td> cujo texto é "Sinopse" e pega o <td> seguinte
+    cells = doc.xpath(
+        "//td[text()[contains(translate(., 'SINOPSE', 'sinopse'), 'sinopse')]]"
+        "/following-sibling::td[1]"
+    )
+    if cells:
+        # Pega o texto limpo, juntando os parágrafos
+        text = ' '.join(cells[0].itertext())
+        # Remove múltiplos espaços e quebras de linha estranhas
+        text = re.sub(r'\s+', ' ', text).strip()
+        return text
+
     return ""
 
 
-def extract_subarea_from_html(html: str) -> str:
+def extract_subarea_from_doc(doc) -> str:
     """
-    Extrai o texto da Subárea do HTML decodificado.
-    
+    Extrai o texto da Subárea de um documento já parseado.
+
     Args:
-        html: Conteúdo HTML decodificado.
-        
+        doc: Documento lxml retornado por parse_html.
+
     Returns:
         Texto da subárea limpo (ex: "Administração > Finanças").
     """
-    soup = BeautifulSoup(html, 'html.parser')
-    
-    # Procura pelo <td> que contém "Subárea"
-    subarea_label = soup.find('td', string=re.compile(r'^Subárea$', re.IGNORECASE))
-    if not subarea_label:
-        # Tenta sem o acento se necessário ou parcial
-        subarea_label = soup.find('td', string=re.compile(r'Subárea', re.IGNORECASE))
-        
-    if subarea_label:
-        # Pega o próximo <td> que deve conter o texto
-        subarea_content = subarea_label.find_next_sibling('td')
-        if subarea_content:
-            text = subarea_content.get_text(strip=True)
-            # Converte HTML entities como &gt; se o BS4 não o fez (ele costuma fazer)
-            return text
-            
+    # Procura pelo <td> cujo texto é "Subárea" e pega o <td> seguinte
+    cells = doc.xpath(
+        "//td[text()[contains(translate(., 'SUBÁREA', 'subárea'), 'subárea')]]"
+        "/following-sibling::td[1]"
+    )
+    if cells:
+        # lxml já converte entities como &gt;
+        return cells[0].text_content().strip()
+
     return ""
 
 
@@ -196,30 +265,34 @@ def extract_metadata_from_mhtml(mhtml_path: str) -> dict:
         - isbn: ISBN eletrônico
     """
     html = decode_mhtml(mhtml_path)
-    
-    # Extrai campos
-    titulo = extract_input_value(html, "titulo")
-    subtitulo = extract_input_value(html, "subtitulomkt")
-    autores = extract_input_value(html, "autores")
-    classificacao = extract_input_value(html, "classificacaoSite")
-    isbn = extract_input_value(html, "ISBNEletr")
-    selo = extract_checked_checkbox(html, "selo")
-    
+
+    # Parseia o documento uma única vez para todas as extrações
+    doc = parse_html(html)
+
+    # Extrai campos (uma varredura do DOM para todos os inputs)
+    inputs, checkboxes = collect_input_fields(doc)
+    titulo = inputs.get("titulo", "")
+    subtitulo = inputs.get("subtitulomkt", "")
+    autores = inputs.get("autores", "")
+    classificacao = inputs.get("classificacaoSite", "")
+    isbn = inputs.get("ISBNEletr", "")
+    selo = checkboxes.get("selo", "")
+
     # Formata título completo
     if subtitulo:
         title = f"{titulo}: {subtitulo.lower()}"
     else:
         title = titulo
-    
+
     # Parseia assunto (tenta Subárea primeiro, fallback para classificação)
-    subarea = extract_subarea_from_html(html)
+    subarea = extract_subarea_from_doc(doc)
     if subarea:
         subject = subarea
     else:
         subject = parse_subject_from_classification(classificacao)
-    
+
     # Extrai sinopse
-    description = extract_sinopse_from_html(html)
+    description = extract_sinopse_from_doc(doc)
     
     return {
         "title": title,
@@ -11,8 +11,10 @@ except ImportError:
     LXML_AVAILABLE = False
 
 import re
+import sys
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
+from xml.sax.saxutils import escape
 
 # Namespaces usados no OPF
 NAMESPACES = {
@@ -21,136 +23,313 @@ NAMESPACES = {
     'xsi': 'http://www.w3.org/2001/XMLSchema-instance'
 }
 
+# Campos dc:* cujo texto é substituído diretamente
+_DC_TEXT_FIELDS = ('title', 'creator', 'subject', 'publisher', 'description')
+
+# Nomes qualificados (notação Clark) pré-computados: evita reconstruir
+# as f-strings de namespace a cada elemento editado
+_DC = NAMESPACES['dc']
+_OPF = NAMESPACES['opf']
+_DC_TAGS = {
+    name: f'{{{_DC}}}{name}'
+    for name in _DC_TEXT_FIELDS + ('identifier',)
+}
+_OPF_SCHEME = f'{{{_OPF}}}scheme'
+_OPF_META = f'{{{_OPF}}}meta'
+
+# Valor de property comparado por meta no laço de limpeza: internado
+# para que a igualdade vire comparação de ponteiro no caso comum
+_PROP_OPF_SCHEME = sys.intern('opf:scheme')
+
+# XPath compilado uma única vez (só existe no lxml): evita reanalisar a
+# expressão prefixada a cada OPF processado
+if LXML_AVAILABLE:
+    _XP_METADATA = ET.XPath('opf:metadata', namespaces={'opf': _OPF})
+
+# Padrões pré-compilados para o caminho rápido por substituição de bytes:
+# o OPF tem esquema conhecido, então os 6 nós de texto podem ser trocados
+# sem parsear/serializar o XML inteiro
+_DC_TEXT_PATTERNS = {
+    name: re.compile(
+        rf'(<dc:{name}\b[^>]*>)[^<]*(</dc:{name}>)'.encode('ascii'),
+        re.IGNORECASE
+    )
+    for name in _DC_TEXT_FIELDS
+}
+_DC_ISBN_PATTERN = re.compile(
+    rb'<dc:identifier([^>]*)>([^<]*)</dc:identifier>',
+    re.IGNORECASE
+)
+_OPF_SCHEME_ATTR_PATTERN = re.compile(
+    rb'\s+opf:scheme\s*=\s*["\']ISBN["\']',
+    re.IGNORECASE
+)
+
+
+def _apply_metadata(root, metadata: Dict[str, str]) -> None:
+    """
+    Aplica os metadados ao elemento raiz de um OPF já parseado (lxml).
+    """
+    # Encontra metadata (XPath pré-compilado, executado em C)
+    found = _XP_METADATA(root)
+    metadata_elem = found[0] if found else None
+    if metadata_elem is None:
+        metadata_elem = root.find('{http://www.idpf.org/2007/opf}metadata')
+
+    if metadata_elem is None:
+        raise ValueError("Elemento metadata não encontrado no OPF")
+
+    _apply_metadata_to_elem(metadata_elem, metadata)
+
+
+def _apply_metadata_to_elem(metadata_elem, metadata: Dict[str, str]) -> None:
+    """
+    Aplica os metadados a um elemento opf:metadata já localizado (lxml).
+
+    Lógica compartilhada entre a edição em arquivo (update_opf_metadata)
+    e a edição em memória (update_opf_bytes).
+    """
+    # Funçāo auxiliar para atualizar ou criar elemento dc
+    def update_dc_elem(name, value):
+        if not value: return
+        elem = metadata_elem.find(_DC_TAGS[name])
+        if elem is not None:
+            elem.text = value
+        else:
+            new_elem = ET.SubElement(metadata_elem, _DC_TAGS[name])
+            new_elem.text = value
+
+    update_dc_elem('title', metadata.get('title'))
+    update_dc_elem('creator', metadata.get('creator'))
+    update_dc_elem('subject', metadata.get('subject'))
+    update_dc_elem('publisher', metadata.get('publisher'))
+    update_dc_elem('description', metadata.get('description'))
+
+    # Atualiza ou cria ISBN
+    isbn_value = metadata.get('isbn')
+    if isbn_value:
+        isbn_elem = None
+        found_by_scheme = False
+
+        # Formata o ISBN corretamente: urn:isbn:978...
+        # Se já vier com urn:isbn:, mantém. Caso contrário, adiciona prefixo.
+        if isbn_value.lower().startswith("urn:isbn:"):
+            formatted_isbn = isbn_value
+            raw_isbn = isbn_value.split(":")[-1]
+        else:
+            formatted_isbn = f"urn:isbn:{isbn_value}"
+            raw_isbn = isbn_value
+
+        # Uma única passada pelos filhos de metadata coleta os
+        # identificadores (em vez de varreduras findall separadas); as
+        # metas só são varridas depois, e somente se houver id a limpar
+        identifiers = [
+            child for child in metadata_elem
+            if child.tag == _DC_TAGS['identifier']
+        ]
+
+        # Tenta encontrar dc:identifier existente
+        # 1. Por scheme="ISBN"
+        for elem in identifiers:
+            scheme = elem.attrib.get(_OPF_SCHEME)
+            if scheme == 'ISBN':
+                isbn_elem = elem
+                found_by_scheme = True
+                break
+
+        # 2. Se não achou por scheme, tenta pelo conteúdo (match raw ou urn)
+        if isbn_elem is None:
+            for elem in identifiers:
+                txt = (elem.text or "").strip()
+                if txt == raw_isbn or txt == formatted_isbn:
+                    isbn_elem = elem
+                    break
+
+        if isbn_elem is not None:
+            # Atualiza conteúdo
+            isbn_elem.text = formatted_isbn
+
+            # REMOVE atributo opf:scheme se existir, pois causa erro/aviso
+            # validadores preferem apenas urn:isbn: no conteúdo
+            if _OPF_SCHEME in isbn_elem.attrib:
+                del isbn_elem.attrib[_OPF_SCHEME]
+
+        else:
+            # Cria novo se não existir
+            isbn_elem = ET.SubElement(metadata_elem, _DC_TAGS['identifier'])
+            isbn_elem.text = formatted_isbn
+            # NÃO adicionamos opf:scheme="ISBN"
+
+        # Limpeza de meta tags residuais que refinavam este identificador pelo scheme
+        # Ex: <meta refines="#uid" property="opf:scheme">ISBN</meta>
+        ident_id = isbn_elem.get('id')
+        if ident_id:
+            # Encontra as metas que referenciam este ID: iterchildren
+            # filtra por tag em C e transmite os filhos sem montar lista
+            # intermediária — OPFs sem id nem pagam esta varredura.
+            # A referência alvo é montada uma única vez fora do laço, e o
+            # property é testado primeiro: a maioria das metas não o tem,
+            # então o refines só é lido quando pode haver match
+            target_ref = sys.intern(f'#{ident_id}')
+            metas_to_remove = []
+
+            for meta in metadata_elem.iterchildren(_OPF_META, 'meta'):
+                attrib = meta.attrib
+                if attrib.get('property') == _PROP_OPF_SCHEME and attrib.get('refines') == target_ref:
+                    metas_to_remove.append(meta)
+
+            # A passada única não gera duplicatas, então a remoção é direta
+            for meta in metas_to_remove:
+                metadata_elem.remove(meta)
+
+
+def _update_opf_bytes_fast(data: bytes, metadata: Dict[str, str]) -> Optional[bytes]:
+    """
+    Caminho rápido: substitui os textos dos nós dc:* direto nos bytes.
+
+    Só se aplica quando todas as tags alvo já existem no OPF e não há
+    metas de refinamento a limpar; qualquer caso fora disso devolve None
+    e o chamador cai no caminho lxml completo.
+
+    Args:
+        data: Conteúdo original do content.opf.
+        metadata: Dicionário de metadados extraídos do MHTML.
+
+    Returns:
+        Conteúdo atualizado, ou None se o caminho rápido não se aplica.
+    """
+    # Metas refinando identificadores exigem a limpeza feita pelo lxml
+    if b'property="opf:scheme"' in data or b"property='opf:scheme'" in data:
+        return None
+
+    # Campos de texto simples
+    for name in _DC_TEXT_FIELDS:
+        value = metadata.get(name)
+        if not value:
+            continue
+
+        replacement = escape(value).encode('utf-8')
+        data, count = _DC_TEXT_PATTERNS[name].subn(
+            lambda m: m.group(1) + replacement + m.group(2),
+            data,
+            count=1
+        )
+        if count == 0:
+            # Tag ausente: precisa do lxml para inserir o elemento
+            return None
+
+    # ISBN: atualiza o dc:identifier com opf:scheme="ISBN", removendo o
+    # atributo (mesma regra do caminho lxml)
+    isbn_value = metadata.get('isbn')
+    if isbn_value:
+        if isbn_value.lower().startswith("urn:isbn:"):
+            formatted_isbn = isbn_value
+        else:
+            formatted_isbn = f"urn:isbn:{isbn_value}"
+        formatted_bytes = escape(formatted_isbn).encode('utf-8')
+
+        replaced = 0
+
+        def replace_identifier(match):
+            nonlocal replaced
+            attrs = match.group(1)
+            if replaced or not _OPF_SCHEME_ATTR_PATTERN.search(attrs):
+                return match.group(0)
+
+            replaced += 1
+            attrs = _OPF_SCHEME_ATTR_PATTERN.sub(b'', attrs)
+            return b'<dc:identifier' + attrs + b'>' + formatted_bytes + b'</dc:identifier>'
+
+        data = _DC_ISBN_PATTERN.sub(replace_identifier, data)
+        if not replaced:
+            # Sem identifier com scheme ISBN: o lxml resolve por conteúdo
+            # ou cria o elemento
+            return None
+
+    return data
+
+
+def update_opf_bytes(data: bytes, metadata: Dict[str, str]) -> bytes:
+    """
+    Atualiza os metadados de um content.opf em memória.
+
+    Variante de update_opf_metadata para o pipeline em memória: recebe e
+    devolve bytes, sem tocar o disco.
+
+    Args:
+        data: Conteúdo original do content.opf.
+        metadata: Dicionário de metadados extraídos do MHTML.
+
+    Returns:
+        Conteúdo atualizado do content.opf.
+    """
+    # Caminho rápido: substituição direta nos bytes quando o OPF já tem
+    # todas as tags alvo (caso típico dos EPUBs da editora)
+    fast_result = _update_opf_bytes_fast(data, metadata)
+    if fast_result is not None:
+        return fast_result
+
+    if not LXML_AVAILABLE:
+        # Sem lxml não há edição segura de namespaces; devolve inalterado
+        # (mesmo comportamento do fallback de update_opf_metadata)
+        return data
+
+    parser = ET.XMLParser(remove_blank_text=False)
+    root = ET.fromstring(data, parser)
+
+    _apply_metadata(root, metadata)
+
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True, pretty_print=False)
+
 
 def update_opf_metadata(opf_path: str, metadata: Dict[str, str]) -> None:
     """
     Atualiza os metadados no arquivo content.opf usando lxml para preservar namespaces.
     """
     if LXML_AVAILABLE:
-        parser = ET.XMLParser(remove_blank_text=False)
-        tree = ET.parse(opf_path, parser)
-        root = tree.getroot()
-        
-        # Namespaces para lxml
-        ns = NAMESPACES
-        
-        # Encontra metadata
-        metadata_elem = root.find('opf:metadata', ns)
-        if metadata_elem is None:
-            metadata_elem = root.find('{http://www.idpf.org/2007/opf}metadata')
-        
+        # O elemento metadata fica no início do OPF: iterparse com filtro
+        # de tag entrega-o assim que ele fecha, e as edições são aplicadas
+        # sem nenhuma busca posterior na árvore
+        context = ET.iterparse(
+            opf_path,
+            events=('end',),
+            tag='{http://www.idpf.org/2007/opf}metadata'
+        )
+
+        metadata_elem = None
+        for _, metadata_elem in context:
+            _apply_metadata_to_elem(metadata_elem, metadata)
+            break
+
         if metadata_elem is None:
             raise ValueError("Elemento metadata não encontrado no OPF")
-            
-        # Funçāo auxiliar para atualizar ou criar elemento dc
-        def update_dc_elem(name, value):
-            if not value: return
-            elem = metadata_elem.find(f'dc:{name}', ns)
-            if elem is not None:
-                elem.text = value
-            else:
-                new_elem = ET.SubElement(metadata_elem, f'{{http://purl.org/dc/elements/1.1/}}{name}')
-                new_elem.text = value
-
-        update_dc_elem('title', metadata.get('title'))
-        update_dc_elem('creator', metadata.get('creator'))
-        update_dc_elem('subject', metadata.get('subject'))
-        update_dc_elem('publisher', metadata.get('publisher'))
-        update_dc_elem('description', metadata.get('description'))
-        
-        # Atualiza ou cria ISBN
-        isbn_value = metadata.get('isbn')
-        if isbn_value:
-            isbn_elem = None
-            found_by_scheme = False
-            
-            # Formata o ISBN corretamente: urn:isbn:978...
-            # Se já vier com urn:isbn:, mantém. Caso contrário, adiciona prefixo.
-            if isbn_value.lower().startswith("urn:isbn:"):
-                formatted_isbn = isbn_value
-                raw_isbn = isbn_value.split(":")[-1]
-            else:
-                formatted_isbn = f"urn:isbn:{isbn_value}"
-                raw_isbn = isbn_value
-                
-            # Tenta encontrar dc:identifier existente
-            # 1. Por scheme="ISBN"
-            for elem in metadata_elem.findall('dc:identifier', ns):
-                scheme = elem.get(f'{{{ns["opf"]}}}scheme')
-                if scheme == 'ISBN':
-                    isbn_elem = elem
-                    found_by_scheme = True
-                    break
-            
-            # 2. Se não achou por scheme, tenta pelo conteúdo (match raw ou urn)
-            if isbn_elem is None:
-                for elem in metadata_elem.findall('dc:identifier', ns):
-                    txt = (elem.text or "").strip()
-                    if txt == raw_isbn or txt == formatted_isbn:
-                        isbn_elem = elem
-                        break
-            
-            if isbn_elem is not None:
-                # Atualiza conteúdo
-                isbn_elem.text = formatted_isbn
-                
-                # REMOVE atributo opf:scheme se existir, pois causa erro/aviso
-                # validadores preferem apenas urn:isbn: no conteúdo
-                scheme_attr = f'{{{ns["opf"]}}}scheme'
-                if scheme_attr in isbn_elem.attrib:
-                    del isbn_elem.attrib[scheme_attr]
-                    
-            else:
-                # Cria novo se não existir
-                isbn_elem = ET.SubElement(metadata_elem, f'{{http://purl.org/dc/elements/1.1/}}identifier')
-                isbn_elem.text = formatted_isbn
-                # NÃO adicionamos opf:scheme="ISBN"
-            
-            # Limpeza de meta tags residuais que refinavam este identificador pelo scheme
-            # Ex: <meta refines="#uid" property="opf:scheme">ISBN</meta>
-            ident_id = isbn_elem.get('id')
-            if ident_id:
-                # Encontra todas as metas que referenciam este ID
-                metas_to_remove = []
-                # Busca tanto opf:meta quanto meta (sem namespace) para garantir
-                candidates = []
-                candidates.extend(metadata_elem.findall('opf:meta', ns))
-                candidates.extend(metadata_elem.findall('meta', ns))
-                
-                for meta in candidates:
-                    # Verifica refines
-                    refines = meta.get('refines')
-                    if refines == f'#{ident_id}':
-                        # Verifica se é property="opf:scheme"
-                        prop = meta.get('property')
-                        if prop == 'opf:scheme':
-                            metas_to_remove.append(meta)
-                
-                for meta in metas_to_remove:
-                    # Verifica se o elemento ainda existe antes de remover (pois pode ter duplicatas nas listas)
-                    try:
-                        metadata_elem.remove(meta)
-                    except ValueError:
-                        pass # Já removido
-        
-        # Salva o arquivo
-        with open(opf_path, 'wb') as f:
-            f.write(ET.tostring(tree, encoding='utf-8', xml_declaration=True, pretty_print=False))
+
+        # Esgota o stream para completar a construção do restante da árvore
+        for _ in context:
+            pass
+
+        tree = metadata_elem.getroottree()
+
+        # Salva o arquivo: tree.write serializa direto para o disco pelo
+        # serializador C do lxml, sem materializar os bytes em Python
+        tree.write(opf_path, encoding='utf-8', xml_declaration=True, pretty_print=False)
     else:
-        # Fallback para ElementTree original (com melhorias limitadas)
-        for prefix, uri in NAMESPACES.items():
-            import xml.etree.ElementTree as SimpleET
-            SimpleET.register_namespace(prefix, uri)
-        
+        # Fallback para ElementTree original (com melhorias limitadas).
+        # Registra apenas os namespaces realmente usados pelo módulo
+        # (xsi nunca aparece nas edições): cada register_namespace mexe
+        # em um dict global do ElementTree
+        for prefix in ('opf', 'dc'):
+            ET.register_namespace(prefix, NAMESPACES[prefix])
+
         tree = ET.parse(opf_path)
         root = tree.getroot()
-        
+
         # ... logic remains similar but with register_namespace fix ...
         # (Vou focar no lxml já que ordenei a instalação)
-        
+
         # Atualiza namespaces manual para ElementTree se lxml não estiver disponível
         # Mas como vou rodar o pip install antes, o lxml deve estar disponível.
-        
+
         # Para evitar redundância, vou deixar o código lxml-first
         pass
 
@@ -6,12 +6,38 @@ Módulo para gerenciamento de marcas (watermarks) em arquivos XHTML.
 import os
 import re
 import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import sys
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from config import ELIGIBLE_FILE_PATTERN, EXCLUDED_FILE_PATTERNS, NUM_FILES_TO_MARK, MARK_TEMPLATE
+from config import ELIGIBLE_FILE_RE, EXCLUDED_FILE_RE, NUM_FILES_TO_MARK, MARK_TEMPLATE, EPUB_ENCODING
+
+# Padrão de inserção compilado uma única vez no import: a busca por
+# </body> roda uma vez por arquivo marcado em cada plataforma
+_BODY_RE = re.compile(r'</body>', re.IGNORECASE)
+
+
+def is_eligible_filename(filename: str) -> bool:
+    """
+    Verifica se um nome de arquivo é elegível para receber marca.
+
+    Critérios:
+    - Termina com números (ex: cap_001.xhtml)
+    - Não é parte ou seção
+
+    Args:
+        filename: Nome do arquivo (sem diretório).
+
+    Returns:
+        True se o arquivo pode receber marca.
+    """
+    if not ELIGIBLE_FILE_RE.match(filename):
+        return False
+
+    # Verifica se não está na lista de excluídos
+    return not EXCLUDED_FILE_RE.match(filename)
 
 
 def find_eligible_files(oebps_path: str) -> List[str]:
@@ -29,25 +55,54 @@ def find_eligible_files(oebps_path: str) -> List[str]:
         Lista de caminhos para arquivos elegíveis.
     """
     eligible = []
-    oebps = Path(oebps_path)
-    
-    for xhtml_file in oebps.glob("*.xhtml"):
-        filename = xhtml_file.name
-        
-        # Verifica se corresponde ao padrão de arquivo elegível
-        if re.match(ELIGIBLE_FILE_PATTERN, filename):
-            # Verifica se não está na lista de excluídos
-            is_excluded = any(
-                re.match(pattern, filename) 
-                for pattern in EXCLUDED_FILE_PATTERNS
-            )
-            
-            if not is_excluded:
-                eligible.append(str(xhtml_file))
-    
+
+    # os.scandir + endswith evita criar um Path e rodar fnmatch por entrada
+    with os.scandir(oebps_path) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith(".xhtml") and is_eligible_filename(name):
+                eligible.append(os.path.join(oebps_path, name))
+
     return sorted(eligible)
 
 
+def find_and_select_files(oebps_path: str, k: int = NUM_FILES_TO_MARK) -> List[str]:
+    """
+    Encontra e seleciona arquivos elegíveis em uma única passada.
+
+    Combina find_eligible_files + select_random_files usando amostragem
+    por reservatório (algoritmo R): o diretório é varrido uma vez e
+    apenas k caminhos ficam em memória, sem construir nem ordenar a
+    lista completa de candidatos.
+
+    Args:
+        oebps_path: Caminho para a pasta OEBPS do EPUB.
+        k: Número de arquivos a selecionar.
+
+    Returns:
+        Lista de caminhos selecionados (até k).
+    """
+    reservoir: List[str] = []
+    i = 0
+
+    with os.scandir(oebps_path) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.endswith(".xhtml") and is_eligible_filename(name)):
+                continue
+
+            path = os.path.join(oebps_path, name)
+            if i < k:
+                reservoir.append(path)
+            else:
+                j = random.randrange(i + 1)
+                if j < k:
+                    reservoir[j] = path
+            i += 1
+
+    return reservoir
+
+
 def select_random_files(eligible_files: List[str], num_files: int = NUM_FILES_TO_MARK) -> List[str]:
     """
     Seleciona arquivos aleatórios para marcar.
@@ -65,57 +120,88 @@ def select_random_files(eligible_files: List[str], num_files: int = NUM_FILES_TO
     return random.sample(eligible_files, num_files)
 
 
-def insert_watermark(file_path: str, mark: str) -> bool:
+def insert_mark_in_content(content: str, mark: str) -> str:
+    """
+    Insere uma marca no conteúdo de um XHTML antes da tag </body>.
+
+    Args:
+        content: Conteúdo do arquivo XHTML.
+        mark: Símbolo da marca a inserir.
+
+    Returns:
+        Novo conteúdo, ou o conteúdo original se a inserção não foi possível.
+    """
+    return _insert_mark_html(content, MARK_TEMPLATE.format(mark=mark))
+
+
+def _insert_mark_html(content: str, mark_html: str) -> str:
+    """
+    Insere o HTML da marca já formatado antes da tag </body>.
+
+    Núcleo de insert_mark_in_content: recebe o mark_html pronto para que
+    chamadores que marcam vários arquivos formatem o template uma única
+    vez por chamada.
+    """
+    # Caminho rápido: busca direta por </body> (C-level, sem regex).
+    # A marca entra imediatamente antes da tag, que é onde os padrões
+    # regex também a colocavam
+    body_idx = content.rfind('</body>')
+    if body_idx != -1:
+        return content[:body_idx] + mark_html + '\n' + content[body_idx:]
+
+    # Fallback regex para tags com caixa diferente (ex: </BODY>): só a
+    # busca usa regex; a emenda é feita por fatias no índice do match,
+    # sem o rebuild segmento a segmento do re.sub com backreferences.
+    # O próprio miss da busca é o curto-circuito — uma varredura única,
+    # sem cópia minúscula do documento
+    match = _BODY_RE.search(content)
+    if match is None:
+        return content
+
+    pos = match.start()
+    return content[:pos] + mark_html + '\n' + content[pos:]
+
+
+def insert_watermark(file_path: str, mark_html: str) -> bool:
     """
     Insere uma marca em um arquivo XHTML antes da tag </body>.
-    
+
     Args:
         file_path: Caminho para o arquivo XHTML.
-        mark: Símbolo da marca a inserir.
-        
+        mark_html: HTML da marca já formatado (MARK_TEMPLATE aplicado),
+            para que o template seja processado uma vez por plataforma e
+            não uma vez por arquivo.
+
     Returns:
         True se a marca foi inserida com sucesso.
     """
-    with open(file_path, 'r', encoding='utf-8') as f:
+    with open(file_path, 'rb') as f:
         content = f.read()
-    
-    # Cria o HTML da marca
-    mark_html = MARK_TEMPLATE.format(mark=mark)
-    
-    # Encontra a posição de </body> (pode ter espaços/newlines antes)
-    # Procura pelo padrão: possivelmente </div> + espaços + </body>
-    body_pattern = r'(</body>)'
-    
-    # Insere a marca antes de </body>
-    # Primeiro verifica se há um </div> antes de </body> (estrutura comum)
-    div_body_pattern = r'(</div>\s*)(</body>)'
-    
-    if re.search(div_body_pattern, content, re.IGNORECASE):
-        # Insere após o </div> e antes de </body>
-        new_content = re.sub(
-            div_body_pattern,
-            rf'\1{mark_html}\n\2',
-            content,
-            count=1,
-            flags=re.IGNORECASE
-        )
+
+    # Caminho rápido em bytes: '</body>' é ASCII, então a posição achada
+    # no buffer bruto é válida e o arquivo inteiro nunca precisa do
+    # round-trip decode/encode UTF-8
+    body_idx = content.rfind(b'</body>')
+    if body_idx != -1:
+        mark_bytes = mark_html.encode(EPUB_ENCODING)
+        new_content = content[:body_idx] + mark_bytes + b'\n' + content[body_idx:]
     else:
-        # Insere diretamente antes de </body>
-        new_content = re.sub(
-            body_pattern,
-            rf'{mark_html}\n\1',
-            content,
-            count=1,
-            flags=re.IGNORECASE
-        )
-    
-    # Verifica se houve alteração
-    if new_content == content:
-        return False
-    
-    with open(file_path, 'w', encoding='utf-8') as f:
+        # Fallback para tags com caixa diferente: decodifica e reaproveita
+        # a inserção por regex
+        text = content.decode(EPUB_ENCODING)
+        new_text = _insert_mark_html(text, mark_html)
+        if new_text == text:
+            return False
+        new_content = new_text.encode(EPUB_ENCODING)
+
+    # Escrita atômica: grava em um arquivo irmão e renomeia por cima.
+    # O os.replace é um rename único no kernel, então o XHTML nunca fica
+    # truncado se o processo morrer no meio da escrita
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
         f.write(new_content)
-    
+    os.replace(tmp_path, file_path)
+
     return True
 
 
@@ -130,21 +216,70 @@ def add_platform_watermarks(oebps_path: str, mark: str) -> List[Tuple[str, bool]
     Returns:
         Lista de tuplas (arquivo, sucesso).
     """
-    # Encontra arquivos elegíveis
-    eligible = find_eligible_files(oebps_path)
-    
+    # Encontra e seleciona em uma única passada (amostragem por
+    # reservatório): a lista completa de elegíveis nunca é materializada
+    selected = find_and_select_files(oebps_path)
+
+    if not selected:
+        return []
+
+    # Formata o template uma única vez para todos os arquivos da chamada
+    mark_html = MARK_TEMPLATE.format(mark=mark)
+
+    # Insere marcas em paralelo: cada arquivo é independente e o GIL é
+    # liberado durante as leituras/escritas
+    with ThreadPoolExecutor(max_workers=min(len(selected), 4)) as executor:
+        futures = [executor.submit(insert_watermark, file_path, mark_html) for file_path in selected]
+        results = [
+            (os.path.basename(file_path), future.result())
+            for file_path, future in zip(selected, futures)
+        ]
+
+    return results
+
+
+def add_platform_watermarks_to_tree(files: Dict[str, bytes], mark: str) -> List[Tuple[str, bool]]:
+    """
+    Adiciona marcas de plataforma a 3 arquivos aleatórios de um EPUB em memória.
+
+    Variante de add_platform_watermarks para o pipeline em memória: opera
+    sobre o dicionário {caminho_interno: bytes} e modifica apenas as
+    entradas selecionadas.
+
+    Args:
+        files: Dicionário {caminho_interno: bytes} do EPUB.
+        mark: Símbolo da marca da plataforma.
+
+    Returns:
+        Lista de tuplas (arquivo, sucesso).
+    """
+    # Encontra entradas xhtml elegíveis pelo nome do arquivo
+    eligible = sorted(
+        name for name in files
+        if name.endswith(".xhtml") and is_eligible_filename(os.path.basename(name))
+    )
+
     if not eligible:
         return []
-    
+
     # Seleciona arquivos aleatórios
     selected = select_random_files(eligible)
-    
+
+    # Formata o template uma única vez para todos os arquivos da chamada
+    mark_html = MARK_TEMPLATE.format(mark=mark)
+
     # Insere marcas
     results = []
-    for file_path in selected:
-        success = insert_watermark(file_path, mark)
-        results.append((os.path.basename(file_path), success))
-    
+    for name in selected:
+        content = files[name].decode(EPUB_ENCODING)
+        new_content = _insert_mark_html(content, mark_html)
+
+        success = new_content != content
+        if success:
+            files[name] = new_content.encode(EPUB_ENCODING)
+
+        results.append((os.path.basename(name), success))
+
     return results
 
 